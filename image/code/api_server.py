@@ -3,12 +3,23 @@ import json
 import logging
 import io
 import os
+import tempfile
+import time
 import requests
 import flask
+import memory
+import metrics
 import websocket  # Note: websocket-client (https://github.com/websocket-client/websocket-client)
 import uuid
-from comfyui_prompt import prompt_for_image_data, upload_image_from
+from comfyui_prompt import delete_history, get_history_images, get_queue, iter_history_image_data, queue_prompt, \
+    upload_image_from, wait_for_prompt
+from health_monitor import read_state
+from storage import remove_history_files, remove_input_files
+from scheduler import CostModel, dispatch_lock, get_cost_features, get_execution_seconds, \
+    get_execution_timestamps, get_finish, get_flow_finish, get_lane, get_priority, get_queue_eta
+from workflow_registry import INPUT_IMAGE_NAME, WorkflowError, WorkflowRegistry
 from PIL import Image
+from werkzeug.wsgi import wrap_file
 
 # Define Logger
 logger = logging.getLogger()
@@ -24,29 +35,71 @@ JPEG_QUALITY = int(os.getenv("JPEG_QUALITY", 90))
 # environment variable to print HTTP header of requests
 DEBUG_HEADER = os.getenv("DEBUG_HEADER", "False").lower() in ("true", "1", "t")
 
+# environment variable to remove the history entry and output files of each prompt once its response is built
+CLEANUP_OUTPUTS = os.getenv("CLEANUP_OUTPUTS", "True").lower() in ("true", "1", "t")
+
+# environment variable to set the size of a response kept in memory, larger responses are spooled to disk
+RESPONSE_SPOOL_BYTES = int(os.getenv("RESPONSE_SPOOL_BYTES", 16 * 1024 ** 2))
+
 # contants for comfyui server
 SERVER_ADDRESS = "127.0.0.1:8188"
 URL_PING = f"http://{SERVER_ADDRESS}"
 
+# environment variable to set the directory of named workflows (packed with the model artifact)
+WORKFLOW_DIR = os.getenv("WORKFLOW_DIR", "/opt/ml/model/workflows")
+
+# named workflows are loaded once at startup, and validated against ComfyUI on first use
+registry = WorkflowRegistry.load(WORKFLOW_DIR)
+
+# execution time model fitted from the executed prompts, shared by all workers
+cost_model = CostModel()
+
 
 @app.route("/ping", methods=["GET"])
 def ping():
     """
     Check the health of the ComfyUI local server is responding
 
+    Answers from the state sampled by the health monitor in background, so that it does not wait for ComfyUI.
+    Falls back to checking ComfyUI directly if the monitor has not written any state yet.
+
     Returns a 200 status code if success, or a 500 status code if there is an error.
 
     Returns:
         flask.Response: A response object containing the status code and mimetype.
     """
-    # Check if the local server is responding, set the status accordingly
-    r = requests.head(URL_PING, timeout=5)
-    status = 200 if r.ok else 500
+    state = read_state()
+    if state is not None:
+        status = 200 if state["healthy"] and not state["stale"] else 500
+    else:
+        # Check if the local server is responding, set the status accordingly
+        r = requests.head(URL_PING, timeout=5)
+        status = 200 if r.ok else 500
 
     # Return the response with the determined status code
     return flask.Response(response="\n", status=status, mimetype="application/json")
 
 
+@app.route("/status", methods=["GET"])
+def status():
+    """
+    Return the state sampled by the health monitor: ComfyUI liveness, WebSocket, queue load, VRAM and recent models.
+
+    Returns a 200 status code if healthy, or a 500 status code otherwise.
+    """
+    state = read_state() or {"healthy": False, "stale": True}
+    healthy = state["healthy"] and not state["stale"]
+    return flask.Response(response=json.dumps(state), status=200 if healthy else 500, mimetype="application/json")
+
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    """
+    Return the metrics aggregated from all processes of the inference server.
+    """
+    return flask.Response(response=json.dumps(metrics.snapshot()), status=200, mimetype="application/json")
+
+
 def get_image_name(prompt_dict):
     for i in prompt_dict:
         if isinstance(prompt_dict[i], str):
@@ -60,6 +113,59 @@ def get_image_name(prompt_dict):
     return None
 
 
+def update_input_image_names(prompt_dict, input_files):
+    """
+    Point the LoadImage nodes referencing an image input name to its uploaded file name.
+
+    Args:
+        prompt_dict (dict): The prompt dictionary.
+        input_files (dict): Image input name to uploaded file name.
+
+    Returns:
+        dict: The updated prompt dictionary.
+    """
+    for i in prompt_dict:
+        if not isinstance(prompt_dict[i], dict):
+            continue
+        if "inputs" in prompt_dict[i]:
+            if (
+                    prompt_dict[i]["class_type"] == "LoadImage"
+                    and prompt_dict[i]["inputs"].get("image") in input_files
+            ):
+                prompt_dict[i]["inputs"]["image"] = input_files[prompt_dict[i]["inputs"]["image"]]
+    return prompt_dict
+
+
+def build_workflow_prompt(request, input_files):
+    """
+    Build the ComfyUI prompt of a named workflow request.
+
+    The request is {"workflow": name, "workflow_version": optional version, "parameters": {...}}.
+
+    Args:
+        request (dict): The request.
+        input_files (dict): Image input name to uploaded file name. INPUT_IMAGE_NAME is the single
+            input image used by all LoadImage nodes, other names are the title or node id of a LoadImage node.
+
+    Returns:
+        dict: The prompt in the converted format.
+
+    Raises:
+        WorkflowError: If the workflow or its parameters are invalid.
+    """
+    registry.validate(SERVER_ADDRESS)
+    workflow = registry.get(request["workflow"], request.get("workflow_version"))
+    parameters = dict(request.get("parameters") or {})
+    input_images = {name: file_name for name, file_name in input_files.items() if name != INPUT_IMAGE_NAME}
+    if INPUT_IMAGE_NAME in input_files:
+        parameters["input_image_name"] = input_files[INPUT_IMAGE_NAME]
+    if input_images:
+        parameters["input_images"] = input_images
+    prompt = workflow.build(parameters, registry.object_info)
+    logger.info(f"Workflow {workflow.identity} built")
+    return prompt
+
+
 @app.route("/invocations", methods=["POST"])
 def invocations():
     """
@@ -67,69 +173,220 @@ def invocations():
     Returns a JSON array containing image data and content types for all generated images.
     """
     global ws, client_id
-    if ws is None or client_id is None:
-        client_id = str(uuid.uuid4())
-        ws = websocket.WebSocket()
-        ws.connect("ws://{}/ws?clientId={}".format(SERVER_ADDRESS, client_id))
-
     if DEBUG_HEADER:
         print(flask.request.headers)
 
-    # get prompt from request body regardless of content type
-    prompt = flask.request.get_json(silent=True, force=True)
+    memory.reset_peak()
+
+    # get prompt from request body regardless of content type, the raw body is not cached
+    prompt = flask.request.get_json(silent=True, force=True, cache=False)
 
+    # status request: /status and /metrics are not reachable through SageMaker, which only forwards /invocations
+    if prompt.get("status") is True:
+        return flask.Response(
+            response=json.dumps({"status": read_state(), "metrics": metrics.snapshot()}),
+            status=200,
+            mimetype="application/json"
+        )
+
+    # log the prompt without the base64 input images
     logger.info("Prompt received in the request")
-    prompt_str = json.dumps(prompt, indent=2)
+    prompt_str = json.dumps({k: v for k, v in prompt.items() if k not in ("input_image", "input_images")}, indent=2)
     logger.info(prompt_str)
+    del prompt_str
+
+    # scheduling options of the request
+    deadline_seconds = prompt.pop("deadline_seconds", None)
+    estimate_only = prompt.pop("estimate_only", False)
+    lane = get_lane(prompt.pop("lane", None))
+    tenant = prompt.pop("tenant", None)
 
-    # if image input is provided, upload it to comfyui server
+    # input images are uploaded under a file name unique to the request, as the workers run concurrently
+    input_images = dict(prompt.pop("input_images", None) or {})
     if prompt.get("input_image"):
-        image_data = prompt["input_image"]
-        image_data = base64.b64decode(image_data)
-        filename = "input1.png"
-        res = upload_image_from(image_data, filename, SERVER_ADDRESS)
-        prompt.pop("input_image")
+        input_images[INPUT_IMAGE_NAME] = prompt.pop("input_image")
+    request_key = uuid.uuid4().hex[:12]
+    input_files = {name: f"{request_key}_{os.path.basename(name)}" for name in input_images}
+
+    # named workflow request: build the prompt from the cached graph and the parameters
+    normalized = "workflow" in prompt
+    if not normalized:
+        prompt = update_input_image_names(prompt, input_files)
     else:
+        try:
+            prompt = build_workflow_prompt(prompt, input_files)
+        except WorkflowError as e:
+            logger.error(f"Error: {e}")
+            return flask.Response(
+                response=json.dumps({"error": "Invalid workflow request", "details": str(e)}),
+                status=400,
+                mimetype="application/json"
+            )
+
+    # estimate the execution time to order the prompt in ComfyUI queue
+    model, work = get_cost_features(prompt)
+    estimate = {"estimated_seconds": cost_model.estimate(model, work), "lane": lane.name}
+    logger.info(f"Estimate for {model} with {work:.1f} units of work: {estimate}")
+    if estimate_only:
+        queue = get_queue()
+        number = get_priority(
+            estimate["estimated_seconds"], deadline_seconds, weight=lane.weight,
+            flow_finish=get_flow_finish(queue, lane.name, tenant)
+        )
+        estimate["queue_eta_seconds"] = get_queue_eta(queue, number)
+        return flask.Response(response=json.dumps({"estimate": estimate}), status=200, mimetype="application/json")
+
+    if ws is None or client_id is None:
+        client_id = str(uuid.uuid4())
+        ws = websocket.WebSocket()
+        ws.connect("ws://{}/ws?clientId={}".format(SERVER_ADDRESS, client_id))
+
+    if not input_files:
         logger.info("No image received in the request")
 
+    # upload the input images before taking the dispatch lock, so that other workers do not wait for the upload,
+    # they are removed if the prompt is not queued
+    try:
+        upload_input_images(input_images, input_files)
+
+        # Queue the prompt in ComfyUI ordered by the fair queue, a full lane is rejected at once so that the
+        # request does not hold a worker, the client retries it later
+        with dispatch_lock():
+            queue = get_queue()
+            if lane.has_capacity(queue):
+                now = time.time()
+                flow_finish = get_flow_finish(queue, lane.name, tenant)
+                number = get_priority(estimate["estimated_seconds"], deadline_seconds, now, lane.weight, flow_finish)
+                estimate["queue_eta_seconds"] = get_queue_eta(queue, number)
+                extra_data = {
+                    "estimated_seconds": estimate["estimated_seconds"], "queued_at": now,
+                    "lane": lane.name, "tenant": tenant,
+                    "finish": get_finish(estimate["estimated_seconds"], now, lane.weight, flow_finish)
+                }
+                prompt_id = queue_prompt(prompt, client_id, normalized, number, extra_data)['prompt_id']
+            else:
+                prompt_id = None
+    except Exception:
+        remove_input_files(list(input_files.values()))
+        raise
+    if prompt_id is None:
+        logger.warning(f"Lane {lane.name} is full")
+        metrics.incr(f"lane_rejected.{lane.name}")
+        remove_input_files(list(input_files.values()))
+        return flask.Response(
+            response=json.dumps({"error": "Lane is full", "details": lane.name, "estimate": estimate}),
+            status=429,
+            mimetype="application/json"
+        )
+
     # Get all generated images
-    image_data_arr = prompt_for_image_data(ws, client_id, prompt)
-    logger.info(f"Number of images generated: {len(image_data_arr)}")
+    history = wait_for_prompt(ws, prompt_id)
+    execution_start = get_execution_timestamps(history).get("execution_start")
+    if execution_start is not None:
+        metrics.observe(f"queue_seconds.{lane.name}", execution_start - extra_data["queued_at"])
+    execution_seconds = get_execution_seconds(history)
+    if execution_seconds is not None:
+        estimate["execution_seconds"] = execution_seconds
+        cost_model.observe(model, work, execution_seconds)
+    total_images = len(get_history_images(history))
+    logger.info(f"Number of images generated: {total_images}")
 
-    # Process each image according to accept headers
-    processed_images = []
     accept_jpeg = "image/jpeg" in flask.request.accept_mimetypes
 
-    for image_data in image_data_arr:
-        current_image = {}
-
-        # Convert PNG to JPEG if requested and possible
-        if accept_jpeg and image_data.get("content_type") == "image/png":
-            png_image = Image.open(io.BytesIO(image_data.get("data")))
-            rgb_image = png_image.convert("RGB")
-            jpeg_bytes = io.BytesIO()
-            rgb_image.save(jpeg_bytes, format="jpeg", optimize=True, quality=JPEG_QUALITY)
-            current_image = {
-                "data": base64.b64encode(jpeg_bytes.getvalue()).decode('utf-8'),
-                "content_type": "image/jpeg"
-            }
-        else:
-            current_image = {
-                "data": base64.b64encode(image_data.get("data")).decode('utf-8'),
-                "content_type": image_data.get("content_type")
-            }
-        processed_images.append(current_image)
-
-    # Return array of all processed images
+    # Build the whole response before sending the status, so that a failure is reported as an error.
+    # Only one image is held in memory at a time, the response is spooled to disk above RESPONSE_SPOOL_BYTES.
+    body = tempfile.SpooledTemporaryFile(max_size=RESPONSE_SPOOL_BYTES)
+    try:
+        write_response(body, history, total_images, accept_jpeg, estimate)
+    except Exception as e:
+        body.close()
+        logger.error(f"Error: {e}")
+        metrics.incr("response_errors")
+        return flask.Response(
+            response=json.dumps({"error": "Failed to build the response", "details": str(e)}),
+            status=500,
+            mimetype="application/json"
+        )
+    finally:
+        # release ComfyUI history, input and output files of the prompt
+        if CLEANUP_OUTPUTS:
+            delete_history(prompt_id)
+            metrics.incr("history_deleted")
+            remove_history_files(history)
+            remove_input_files(list(input_files.values()))
+    body.seek(0)
     return flask.Response(
-        response=json.dumps({
-            "images": processed_images,
-            "total_images": len(processed_images)
-        }),
+        response=wrap_file(flask.request.environ, body),
         status=200,
-        mimetype="application/json"
+        mimetype="application/json",
+        direct_passthrough=True
     )
 
 
+def upload_input_images(input_images, input_files):
+    """
+    Upload the base64 input images to ComfyUI input directory.
+
+    Args:
+        input_images (dict): Image input name to base64 image, emptied as the images are uploaded.
+        input_files (dict): Image input name to uploaded file name.
+    """
+    for name in list(input_images):
+        # pop the base64 string so that it is released once decoded
+        image_data = base64.b64decode(input_images.pop(name))
+        upload_image_from(image_data, input_files[name], SERVER_ADDRESS)
+        del image_data
+
+
+def encode_image(image_data, accept_jpeg):
+    """
+    Encode an image for the response, converting PNG to JPEG if accepted.
+
+    Args:
+        image_data (dict): Image data and content type.
+        accept_jpeg (bool): Whether the client accepts JPEG.
+
+    Returns:
+        tuple: The base64 encoded image (bytes) and its content type
+    """
+    # Convert PNG to JPEG if requested and possible
+    if accept_jpeg and image_data.get("content_type") == "image/png":
+        with Image.open(io.BytesIO(image_data.pop("data"))) as png_image:
+            rgb_image = png_image.convert("RGB")
+        jpeg_bytes = io.BytesIO()
+        rgb_image.save(jpeg_bytes, format="jpeg", optimize=True, quality=JPEG_QUALITY)
+        del rgb_image
+        with jpeg_bytes.getbuffer() as jpeg_buffer:
+            return base64.b64encode(jpeg_buffer), "image/jpeg"
+    return base64.b64encode(image_data.pop("data")), image_data.get("content_type")
+
+
+def write_response(body, history, total_images, accept_jpeg, estimate):
+    """
+    Write the JSON response of all generated images, fetching and encoding one image at a time.
+    The response is {"images": [{"data", "content_type"}, ...], "total_images", "estimate"}.
+
+    Args:
+        body (file): The binary file the response is written to.
+    """
+    body.write(b'{"images": [')
+    for i, image_data in enumerate(iter_history_image_data(history)):
+        data, content_type = encode_image(image_data, accept_jpeg)
+        del image_data
+        body.write(b'{"data": "' if i == 0 else b', {"data": "')
+        body.write(data)
+        del data
+        body.write(f'", "content_type": {json.dumps(content_type)}}}'.encode("utf-8"))
+    body.write(f'], "total_images": {total_images}, "estimate": {json.dumps(estimate)}'.encode("utf-8"))
+
+    peak = memory.get_peak()
+    for name, value in peak.items():
+        metrics.observe(f"request_{name}", value)
+    logger.info(f"Memory of the request: {peak}")
+    if memory.DEBUG_MEMORY:
+        body.write(f', "memory": {json.dumps(peak)}'.encode("utf-8"))
+    body.write(b'}')
+
+
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=8080)
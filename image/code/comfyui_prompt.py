@@ -3,7 +3,6 @@ import uuid
 import json
 import urllib.request
 import urllib.parse
-from requests_toolbelt import MultipartEncoder
 import urllib.request
 import requests
 import io
@@ -36,9 +35,16 @@ def convert_prompt_format(prompt):
     return converted_prompt
 
 
-def queue_prompt(prompt, client_id):
-    prompt = convert_prompt_format(prompt)
+def queue_prompt(prompt, client_id, normalized=False, number=None, extra_data=None):
+    # prompts built from the workflow registry are already in the converted format
+    if not normalized:
+        prompt = convert_prompt_format(prompt)
     p = {"prompt": prompt, "client_id": client_id}
+    # ComfyUI executes the pending prompt with the lowest number first
+    if number is not None:
+        p["number"] = number
+    if extra_data is not None:
+        p["extra_data"] = extra_data
     data = json.dumps(p).encode('utf-8')
     req = urllib.request.Request("http://{}/prompt".format(server_address), data=data)
     return json.loads(urllib.request.urlopen(req).read())
@@ -62,11 +68,23 @@ def get_image_data(filename, subfolder, folder_type):
         return image_data
 
 
+def get_queue():
+    with urllib.request.urlopen("http://{}/queue".format(server_address)) as response:
+        return json.loads(response.read())
+
+
 def get_history(prompt_id):
     with urllib.request.urlopen("http://{}/history/{}".format(server_address, prompt_id)) as response:
         return json.loads(response.read())
 
 
+def delete_history(prompt_id):
+    data = json.dumps({"delete": [prompt_id]}).encode('utf-8')
+    req = urllib.request.Request("http://{}/history".format(server_address), data=data)
+    with urllib.request.urlopen(req) as response:
+        return response.read()
+
+
 def get_images(ws, client_id, prompt):
     prompt_id = queue_prompt(prompt, client_id)['prompt_id']
     output_images = {}
@@ -95,14 +113,13 @@ def get_images(ws, client_id, prompt):
     return output_images
 
 
-def prompt_for_image_data(ws, client_id, prompt):
+def wait_for_prompt(ws, prompt_id):
     """
-    Execute prompt to get image data for all generated images.
+    Wait until a queued prompt is executed.
 
     Returns:
-        list: List of dictionaries containing image data and content type
+        dict: The ComfyUI history entry of the prompt
     """
-    prompt_id = queue_prompt(prompt, client_id)['prompt_id']
     while True:
         out = ws.recv()
         if isinstance(out, str):
@@ -114,24 +131,39 @@ def prompt_for_image_data(ws, client_id, prompt):
         else:
             continue  # previews are binary data
 
-    history = get_history(prompt_id)[prompt_id]
-    image_data_arr = []
+    return get_history(prompt_id)[prompt_id]
 
-    # Collect all images from all output nodes
+
+def get_history_images(history):
+    """
+    Get the images of all output nodes of a history entry.
+
+    Returns:
+        list: List of dictionaries containing filename, subfolder and type of each image
+    """
+    images = []
     for node_id in history['outputs']:
         node_output = history['outputs'][node_id]
         if 'images' in node_output:
-            for image in node_output['images']:
-                image_data = get_image_data(image['filename'], image['subfolder'], image['type'])
-                image_data_arr.append(image_data)
+            images.extend(node_output['images'])
+    return images
+
+
+def iter_history_image_data(history):
+    """
+    Fetch image data of all images of the output nodes of a history entry, one image at a time.
 
-    return image_data_arr
+    Yields:
+        dict: Image data and content type
+    """
+    for image in get_history_images(history):
+        yield get_image_data(image['filename'], image['subfolder'], image['type'])
 
 
 def upload_image_from(image_data, name, server_address, image_type="input", overwrite=True):
     """
     Args:
-        image_data (bytes): The image data to upload.
+        image_data (bytes-like): The image data to upload.
         name (str): The name to assign to the uploaded image.
         server_address (str): The server endpoint for uploading images.
         image_type (str, optional): The type of image. Defaults to "input".
@@ -141,20 +173,28 @@ def upload_image_from(image_data, name, server_address, image_type="input", over
         str: The response from the server.
     """
 
-    # Step 2: Prepare multipart form data
-    multipart_data = MultipartEncoder(
-        fields={
-            'image': (name, image_data, 'image/png'),  # Change MIME type if needed
-            'type': image_type,
-            'overwrite': str(overwrite).lower()
-        }
-    )
-
-    # Step 3: Send POST request
+    # Prepare multipart form data, the image data is sent from its buffer without being copied
+    boundary = uuid.uuid4().hex
+    head = (
+        f'--{boundary}\r\n'
+        f'Content-Disposition: form-data; name="type"\r\n\r\n{image_type}\r\n'
+        f'--{boundary}\r\n'
+        f'Content-Disposition: form-data; name="overwrite"\r\n\r\n{str(overwrite).lower()}\r\n'
+        f'--{boundary}\r\n'
+        f'Content-Disposition: form-data; name="image"; filename="{name}"\r\n'
+        f'Content-Type: image/png\r\n\r\n'  # Change MIME type if needed
+    ).encode('utf-8')
+    tail = f'\r\n--{boundary}--\r\n'.encode('utf-8')
+    body = memoryview(image_data)
+
+    # Send POST request
     upload_url = f"http://{server_address}/upload/image"  # Ensure this endpoint is correct
-    headers = {'Content-Type': multipart_data.content_type}
+    headers = {
+        'Content-Type': f'multipart/form-data; boundary={boundary}',
+        'Content-Length': str(len(head) + body.nbytes + len(tail)),
+    }
 
-    req = urllib.request.Request(upload_url, data=multipart_data, headers=headers)
+    req = urllib.request.Request(upload_url, data=[head, body, tail], headers=headers)
     with urllib.request.urlopen(req) as response:
         return response.read().decode('utf-8')  # Decode response if it's in bytes
 
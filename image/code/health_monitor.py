@@ -0,0 +1,201 @@
+import json
+import logging
+import os
+import threading
+import time
+import urllib.request
+import uuid
+
+import metrics
+import websocket  # Note: websocket-client (https://github.com/websocket-client/websocket-client)
+
+logger = logging.getLogger(__name__)
+
+# environment variables to set how often ComfyUI is sampled, and after how long without a sample it is unhealthy
+HEALTH_CHECK_INTERVAL = float(os.getenv("HEALTH_CHECK_INTERVAL", 2))
+HEALTH_STALE_SECONDS = float(os.getenv("HEALTH_STALE_SECONDS", 30))
+
+# file where the monitor writes the sampled state, read by all gunicorn workers
+HEALTH_STATE_FILE = os.getenv("HEALTH_STATE_FILE", "/tmp/comfyui_health.json")
+
+# environment variable to set how often the state and metrics are logged as one JSON line (e.g. to CloudWatch), 0 disables
+HEALTH_LOG_INTERVAL = float(os.getenv("HEALTH_LOG_INTERVAL", 60))
+
+# environment variable to set the number of consecutive failed samples after which ComfyUI is unhealthy
+HEALTH_FAILURE_THRESHOLD = int(os.getenv("HEALTH_FAILURE_THRESHOLD", 3))
+
+# timeout of each request to ComfyUI, it may be slow to answer while a prompt is executed
+HEALTH_CHECK_TIMEOUT = 5
+
+# number of recently executed models reported
+RECENT_MODELS = 5
+
+MODEL_INPUTS = ("ckpt_name", "unet_name")
+
+
+def _get_json(server_address, path):
+    with urllib.request.urlopen(f"http://{server_address}{path}", timeout=HEALTH_CHECK_TIMEOUT) as response:
+        return json.loads(response.read())
+
+
+def get_queue_state(queue):
+    """
+    Summarize the response of ComfyUI /queue.
+
+    Returns:
+        dict: Running and pending prompt counts, pending prompts by lane and expected seconds of the backlog.
+    """
+    running = queue.get("queue_running", [])
+    pending = queue.get("queue_pending", [])
+    lanes = {}
+    backlog = 0.0
+    for item in running + pending:
+        extra_data = item[3] if len(item) > 3 else {}
+        lane = extra_data.get("lane")
+        if lane is not None:
+            lanes[lane] = lanes.get(lane, 0) + 1
+        backlog += extra_data.get("estimated_seconds", 0.0)
+    return {"running": len(running), "pending": len(pending), "lanes": lanes, "backlog_seconds": backlog}
+
+
+def get_prompt_models(prompt):
+    """
+    Get the model names loaded by a prompt graph.
+    """
+    return [
+        node["inputs"][k]
+        for node in prompt.values()
+        if isinstance(node, dict) and "inputs" in node
+        for k in MODEL_INPUTS
+        if isinstance(node["inputs"].get(k), str)
+    ]
+
+
+class HealthMonitor:
+    """
+    Sample ComfyUI liveness, queue, VRAM and WebSocket state in background.
+
+    The state is written to HEALTH_STATE_FILE, so that /ping and /status of every gunicorn
+    worker answer from it without calling ComfyUI. Liveness is based on /system_stats only,
+    ComfyUI is unhealthy after HEALTH_FAILURE_THRESHOLD consecutive failures (and until it first
+    answers). Queue and WebSocket failures are reported in the state but do not affect liveness.
+    """
+
+    def __init__(self, server_address, path=HEALTH_STATE_FILE, failure_threshold=HEALTH_FAILURE_THRESHOLD):
+        self.server_address = server_address
+        self.path = path
+        self.failure_threshold = failure_threshold
+        self.failures = failure_threshold
+        self.ws = None
+        self.recent_models = []
+
+    def _check_websocket(self):
+        # keep one connection open, drain the status messages broadcast by ComfyUI, and reconnect on failure
+        try:
+            if self.ws is None or not self.ws.connected:
+                self.ws = websocket.WebSocket()
+                self.ws.connect(
+                    "ws://{}/ws?clientId={}".format(self.server_address, uuid.uuid4()), timeout=HEALTH_CHECK_TIMEOUT
+                )
+            self.ws.settimeout(0.01)
+            try:
+                while True:
+                    self.ws.recv()
+            except websocket.WebSocketTimeoutException:
+                pass
+            self.ws.ping()
+            return True
+        except Exception as e:
+            logger.warning(f"ComfyUI WebSocket check failed: {e}")
+            if self.ws is not None:
+                self.ws.close()
+            self.ws = None
+            return False
+
+    def sample(self):
+        """
+        Sample the state of ComfyUI.
+
+        Returns:
+            dict: The sampled state.
+        """
+        state = {"timestamp": time.time(), "comfyui": False, "websocket": False}
+        try:
+            system_stats = _get_json(self.server_address, "/system_stats")
+            state["comfyui"] = True
+            self.failures = 0
+        except Exception as e:
+            logger.warning(f"ComfyUI check failed: {e}")
+            self.failures += 1
+        state["failures"] = self.failures
+        state["healthy"] = self.failures < self.failure_threshold
+        if not state["comfyui"]:
+            return state
+
+        state["devices"] = [
+            {k: device.get(k) for k in ("name", "vram_total", "vram_free", "torch_vram_total", "torch_vram_free")}
+            for device in system_stats.get("devices", [])
+        ]
+        try:
+            queue = _get_json(self.server_address, "/queue")
+        except Exception as e:
+            logger.warning(f"ComfyUI queue check failed: {e}")
+            state["queue_error"] = str(e)
+        else:
+            state["queue"] = get_queue_state(queue)
+            for item in queue.get("queue_running", []):
+                for model in get_prompt_models(item[2]):
+                    if model in self.recent_models:
+                        self.recent_models.remove(model)
+                    self.recent_models.insert(0, model)
+            del self.recent_models[RECENT_MODELS:]
+        state["recent_models"] = list(self.recent_models)
+        state["websocket"] = self._check_websocket()
+        return state
+
+    def write(self, state):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.path)
+
+    def start(self, interval=HEALTH_CHECK_INTERVAL):
+        """
+        Start a daemon thread sampling ComfyUI every interval seconds.
+
+        Returns:
+            threading.Thread: The started thread.
+        """
+
+        def run():
+            logged = 0.0
+            while True:
+                try:
+                    state = self.sample()
+                    self.write(state)
+                    if HEALTH_LOG_INTERVAL > 0 and state["timestamp"] - logged >= HEALTH_LOG_INTERVAL:
+                        logger.info(json.dumps({"health": state, "metrics": metrics.snapshot()}))
+                        logged = state["timestamp"]
+                except Exception as e:
+                    logger.error(f"Health monitor failed: {e}")
+                time.sleep(interval)
+
+        thread = threading.Thread(target=run, name="health-monitor", daemon=True)
+        thread.start()
+        return thread
+
+
+def read_state(path=HEALTH_STATE_FILE):
+    """
+    Read the last state written by the monitor.
+
+    Returns:
+        dict: The state with "stale" set if it is older than HEALTH_STALE_SECONDS, or None if there is no state yet.
+    """
+    try:
+        with open(path) as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return None
+    state["stale"] = time.time() - state.get("timestamp", 0) > HEALTH_STALE_SECONDS
+    return state
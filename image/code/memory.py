@@ -0,0 +1,51 @@
+import logging
+import os
+import resource
+import tracemalloc
+
+logger = logging.getLogger(__name__)
+
+# environment variable to trace python allocations of each request (adds overhead)
+DEBUG_MEMORY = os.getenv("DEBUG_MEMORY", "False").lower() in ("true", "1", "t")
+
+if DEBUG_MEMORY:
+    tracemalloc.start()
+
+
+def reset_peak():
+    """
+    Reset the peak memory of this process, so that get_peak returns the peak since this call.
+    """
+    # writing 5 to clear_refs resets the peak RSS (VmHWM) of the process on Linux
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+    if DEBUG_MEMORY:
+        tracemalloc.reset_peak()
+
+
+def get_peak():
+    """
+    Get the peak memory of this process since the last reset_peak.
+
+    Returns:
+        dict: "peak_rss_bytes", and "peak_alloc_bytes" of python allocations if DEBUG_MEMORY is set.
+    """
+    peak = {"peak_rss_bytes": _get_peak_rss()}
+    if DEBUG_MEMORY:
+        peak["peak_alloc_bytes"] = tracemalloc.get_traced_memory()[1]
+    return peak
+
+
+def _get_peak_rss():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # peak since the process started, in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
@@ -0,0 +1,80 @@
+import glob
+import json
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+# environment variable to set the directory where every process (gunicorn workers and serve) writes its metrics
+METRICS_DIR = os.getenv("METRICS_DIR", "/tmp/comfyui_metrics")
+
+_lock = threading.Lock()
+_counters = {}
+_summaries = {}
+
+
+def incr(name, value=1):
+    """
+    Increase a counter of this process.
+
+    Args:
+        name (str): The name of the counter.
+        value (int, optional): The value to add. Defaults to 1.
+    """
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+        _flush()
+
+
+def observe(name, value):
+    """
+    Add an observation to a summary (count, sum, max) of this process.
+
+    Args:
+        name (str): The name of the summary.
+        value (float): The observed value.
+    """
+    with _lock:
+        summary = _summaries.setdefault(name, {"count": 0, "sum": 0.0, "max": value})
+        summary["count"] += 1
+        summary["sum"] += value
+        summary["max"] = max(summary["max"], value)
+        _flush()
+
+
+def _flush():
+    # one file per process, replaced atomically so that readers never see a partial file
+    try:
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        path = os.path.join(METRICS_DIR, f"{os.getpid()}.json")
+        with open(path + ".tmp", "w") as f:
+            json.dump({"counters": _counters, "summaries": _summaries}, f)
+        os.replace(path + ".tmp", path)
+    except OSError as e:
+        logger.warning(f"Failed to write metrics: {e}")
+
+
+def snapshot():
+    """
+    Aggregate the metrics of all processes.
+
+    Returns:
+        dict: {"counters": {name: value}, "summaries": {name: {"count", "sum", "max"}}}
+    """
+    counters = {}
+    summaries = {}
+    for path in glob.glob(os.path.join(METRICS_DIR, "*.json")):
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            continue
+        for name, value in data.get("counters", {}).items():
+            counters[name] = counters.get(name, 0) + value
+        for name, summary in data.get("summaries", {}).items():
+            total = summaries.setdefault(name, {"count": 0, "sum": 0.0, "max": summary["max"]})
+            total["count"] += summary["count"]
+            total["sum"] += summary["sum"]
+            total["max"] = max(total["max"], summary["max"])
+    return {"counters": counters, "summaries": summaries}
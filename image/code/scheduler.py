@@ -0,0 +1,384 @@
+import contextlib
+import fcntl
+import json
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+# environment variable to set how strongly short jobs are preferred: a job is queued as if it arrived
+# SCHEDULER_SJF_WEIGHT times its expected seconds (divided by the lane weight) after its fair queue finish.
+# 0 keeps the fair queue order only.
+SCHEDULER_SJF_WEIGHT = float(os.getenv("SCHEDULER_SJF_WEIGHT", 4))
+
+# environment variable to cap the aging delay of a job, so that a long job overtaken by short ones still completes
+# within the timeout of the inference server workers (INFERENCE_SERVER_TIMEOUT). Defaults to a quarter of it.
+SCHEDULER_MAX_AGING_SECONDS = float(
+    os.getenv("SCHEDULER_MAX_AGING_SECONDS", float(os.getenv("INFERENCE_SERVER_TIMEOUT", 70)) / 4)
+)
+
+# environment variable to set the file shared by all workers to persist the fitted cost model
+COST_MODEL_FILE = os.getenv("COST_MODEL_FILE", "/tmp/comfyui_cost_model.json")
+
+# environment variable to set the priority lanes as name:weight:max_queued, comma separated. A lane with twice the
+# weight gets twice the GPU time under contention, max_queued caps its prompts in ComfyUI queue,
+# requests over the cap are rejected (0 for no cap)
+SCHEDULER_LANES = os.getenv("SCHEDULER_LANES", "interactive:8:0,default:2:0,bulk:1:2")
+
+# environment variable to set the lane of requests without lane (or with an unknown lane)
+SCHEDULER_DEFAULT_LANE = os.getenv("SCHEDULER_DEFAULT_LANE", "default")
+
+# lock file serializing the dispatch of prompts of all workers
+DISPATCH_LOCK_FILE = "/tmp/comfyui_dispatch.lock"
+
+# weight of past observations, closer to 1 adapts slower
+COST_MODEL_DECAY = 0.98
+
+# prior seconds per unit of work (megapixel x step x image) and fixed seconds per prompt, by model family
+PRIOR_SECONDS_PER_UNIT = {"flux": 0.12, "default": 0.04}
+PRIOR_OVERHEAD_SECONDS = 1.0
+
+# weight of the prior, in number of observations
+PRIOR_WEIGHT = 2.0
+
+# cost of an upscale relative to one sampling step on the same number of pixels
+UPSCALE_STEP_EQUIVALENT = 2.0
+
+SAMPLER_CLASS_TYPES = ("KSampler", "KSamplerAdvanced")
+LATENT_CLASS_TYPES = ("EmptyLatentImage", "EmptySD3LatentImage")
+UPSCALE_CLASS_TYPES = ("ImageScale", "ImageScaleBy", "ImageUpscaleWithModel", "LatentUpscale")
+MODEL_INPUTS = ("ckpt_name", "unet_name")
+
+
+def get_cost_features(prompt):
+    """
+    Extract the features of a prompt that drive its GPU time.
+
+    Args:
+        prompt (dict): The prompt graph in ComfyUI API format.
+
+    Returns:
+        tuple: (model name, units of work), where a unit of work is one sampling step on one megapixel image.
+    """
+    nodes = [node for node in prompt.values() if isinstance(node, dict) and "class_type" in node]
+    model = None
+    pixels = None
+    upscale_pixels = 0
+    batch = 1
+    steps = 0
+    for node in nodes:
+        class_type = node["class_type"]
+        inputs = node.get("inputs", {})
+        if model is None:
+            model = next((inputs[k] for k in MODEL_INPUTS if isinstance(inputs.get(k), str)), None)
+        if class_type in SAMPLER_CLASS_TYPES and isinstance(inputs.get("steps"), (int, float)):
+            steps += inputs["steps"]
+        if class_type in LATENT_CLASS_TYPES:
+            pixels = _number(inputs.get("width"), 1024) * _number(inputs.get("height"), 1024)
+            batch *= _number(inputs.get("batch_size"), 1)
+        if class_type == "RepeatLatentBatch":
+            batch *= _number(inputs.get("amount"), 1)
+        if class_type in UPSCALE_CLASS_TYPES:
+            upscale_pixels += _number(inputs.get("width"), 0) * _number(inputs.get("height"), 0)
+    if pixels is None:
+        # img2img: the latent is encoded from the (scaled) input image
+        pixels = upscale_pixels or 1024 * 1024
+        upscale_pixels = 0
+    work = batch * (steps * pixels + UPSCALE_STEP_EQUIVALENT * upscale_pixels) / 1e6
+    return model or "default", work
+
+
+def _number(value, default):
+    # inputs can be links to other nodes ([node_id, index]) instead of constants
+    return value if isinstance(value, (int, float)) else default
+
+
+class CostModel:
+    """
+    Linear model of the execution seconds of a prompt, seconds = overhead + rate * work, per model.
+
+    It is fitted by exponentially weighted least squares from the observed execution times, regularized by
+    a prior by model family. The prior is added at estimate time and never decayed, so that the rate stays
+    anchored when most observations have the same work. The sums of the observations are persisted in
+    COST_MODEL_FILE, so all gunicorn workers share what each of them observes.
+    """
+
+    def __init__(self, path=COST_MODEL_FILE):
+        self.path = path
+        self.stats = {}
+        self.mtime = None
+
+    def _prior_rate(self, model):
+        family = "flux" if "flux" in model.lower() else "default"
+        return PRIOR_SECONDS_PER_UNIT[family]
+
+    def _prior(self, model):
+        rate = self._prior_rate(model)
+        # pseudo observations at 0 and 10 units of work
+        w = PRIOR_WEIGHT / 2
+        points = [(0.0, PRIOR_OVERHEAD_SECONDS), (10.0, PRIOR_OVERHEAD_SECONDS + 10.0 * rate)]
+        return {
+            "n": PRIOR_WEIGHT,
+            "x": sum(w * x for x, _ in points),
+            "y": sum(w * y for _, y in points),
+            "xx": sum(w * x * x for x, _ in points),
+            "xy": sum(w * x * y for x, y in points),
+        }
+
+    def _reload(self):
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            return
+        if mtime == self.mtime:
+            return
+        try:
+            with open(self.path) as f:
+                self.stats = json.load(f)
+            self.mtime = mtime
+        except (OSError, ValueError) as e:
+            logger.warning(f"Failed to read cost model {self.path}: {e}")
+
+    def estimate(self, model, work):
+        """
+        Estimate the execution seconds of a prompt.
+
+        Args:
+            model (str): The model name returned by get_cost_features.
+            work (float): The units of work returned by get_cost_features.
+
+        Returns:
+            float: The expected execution seconds.
+        """
+        self._reload()
+        prior = self._prior(model)
+        observed = self.stats.get(model, {})
+        s = {k: v + observed.get(k, 0.0) for k, v in prior.items()}
+        det = s["n"] * s["xx"] - s["x"] * s["x"]
+        if det <= 1e-9 * s["n"] * s["xx"]:
+            # no spread of the work values, keep the prior rate
+            rate = self._prior_rate(model)
+        else:
+            rate = max((s["n"] * s["xy"] - s["x"] * s["y"]) / det, 0.0)
+        overhead = (s["y"] - rate * s["x"]) / s["n"]
+        return max(overhead + rate * work, 0.0)
+
+    def observe(self, model, work, seconds):
+        """
+        Add an observed execution time to the model, and persist it.
+
+        Args:
+            model (str): The model name returned by get_cost_features.
+            work (float): The units of work returned by get_cost_features.
+            seconds (float): The observed execution seconds.
+        """
+        with open(self.path + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self.mtime = None
+            self._reload()
+            s = self.stats.get(model) or {"n": 0.0, "x": 0.0, "y": 0.0, "xx": 0.0, "xy": 0.0}
+            s = {k: v * COST_MODEL_DECAY for k, v in s.items()}
+            s["n"] += 1
+            s["x"] += work
+            s["y"] += seconds
+            s["xx"] += work * work
+            s["xy"] += work * seconds
+            self.stats[model] = s
+            tmp_path = f"{self.path}.{os.getpid()}"
+            with open(tmp_path, "w") as f:
+                json.dump(self.stats, f)
+            os.replace(tmp_path, self.path)
+
+
+class Lane:
+    """
+    A priority lane: its weight in the fair queue and its cap of prompts in ComfyUI queue.
+    """
+
+    def __init__(self, name, weight, max_queued):
+        self.name = name
+        self.weight = weight
+        self.max_queued = max_queued
+
+    def has_capacity(self, queue):
+        """
+        Check whether a prompt of the lane can be queued, given the response of ComfyUI /queue.
+        """
+        if self.max_queued <= 0:
+            return True
+        count = sum(1 for extra_data in _iter_extra_data(queue) if extra_data.get("lane") == self.name)
+        return count < self.max_queued
+
+
+def parse_lanes(spec):
+    """
+    Parse the lanes from name:weight:max_queued, comma separated.
+
+    Returns:
+        dict: Lane name to Lane.
+    """
+    lanes = {}
+    for item in spec.split(","):
+        if not item.strip():
+            continue
+        name, weight, max_queued = (item.strip().split(":") + ["1", "0"])[:3]
+        lanes[name] = Lane(name, float(weight), int(max_queued))
+    return lanes
+
+
+LANES = parse_lanes(SCHEDULER_LANES)
+
+
+def get_lane(name):
+    """
+    Get a lane by name, unknown names fall back to SCHEDULER_DEFAULT_LANE.
+    """
+    if name in LANES:
+        return LANES[name]
+    if name is not None:
+        logger.warning(f"Unknown lane {name}, using {SCHEDULER_DEFAULT_LANE}")
+    return LANES.get(SCHEDULER_DEFAULT_LANE) or Lane(SCHEDULER_DEFAULT_LANE, 1.0, 0)
+
+
+def _iter_extra_data(queue):
+    for item in queue.get("queue_running", []) + queue.get("queue_pending", []):
+        yield item[3] if len(item) > 3 else {}
+
+
+def get_flow_finish(queue, lane, tenant):
+    """
+    Get the highest finish tag of the queued prompts of a flow (a lane and tenant), or None if it has none.
+    Prompts queued without a finish tag count with their queue number.
+
+    Args:
+        queue (dict): The response of ComfyUI /queue.
+        lane (str): The lane name.
+        tenant (str): The tenant, can be None.
+    """
+    finishes = [
+        item[3].get("finish", item[0])
+        for item in queue.get("queue_running", []) + queue.get("queue_pending", [])
+        if len(item) > 3 and item[3].get("lane") == lane and item[3].get("tenant") == tenant
+    ]
+    return max(finishes) if finishes else None
+
+
+@contextlib.contextmanager
+def dispatch_lock():
+    """
+    Hold a lock shared by all workers, so that reading the queue and queueing a prompt are atomic.
+    """
+    with open(DISPATCH_LOCK_FILE, "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def get_finish(estimated_seconds, now=None, weight=1.0, flow_finish=None):
+    """
+    Compute the finish tag of a prompt in the weighted fair queue (virtual clock) over flows of a lane and tenant.
+
+    A prompt starts after the prompts already queued by its flow, and its expected seconds are divided by the
+    lane weight, so that a lane with twice the weight gets twice the GPU time under contention.
+
+    Args:
+        estimated_seconds (float): The expected execution seconds.
+        now (float, optional): The current time. Defaults to time.time().
+        weight (float, optional): The weight of the lane. Defaults to 1.
+        flow_finish (float, optional): The highest finish tag of the queued prompts of the same flow.
+
+    Returns:
+        float: The finish tag.
+    """
+    now = time.time() if now is None else now
+    start = now if flow_finish is None else max(now, flow_finish)
+    return start + estimated_seconds / weight
+
+
+def get_priority(estimated_seconds, deadline_seconds=None, now=None, weight=1.0, flow_finish=None):
+    """
+    Compute the ComfyUI queue number of a prompt, the lowest number is executed first.
+
+    The prompt is ordered by its fair queue finish tag (see get_finish), aged by SCHEDULER_SJF_WEIGHT times its
+    weighted expected seconds, at most SCHEDULER_MAX_AGING_SECONDS. With a single flow it is
+    shortest-expected-job-first with aging, a long job is overtaken only by jobs arriving within that delay. A job with a deadline is ordered no later than its latest
+    start time, but not before its finish tag: a deadline only cancels the aging, so that it cannot take the
+    share of other flows (e.g. a bulk job with deadline 0 is not ordered before interactive jobs).
+
+    Args:
+        estimated_seconds (float): The expected execution seconds.
+        deadline_seconds (float, optional): Seconds from now by which the job should be completed.
+        now (float, optional): The current time. Defaults to time.time().
+        weight (float, optional): The weight of the lane. Defaults to 1.
+        flow_finish (float, optional): The highest finish tag of the queued prompts of the same flow.
+
+    Returns:
+        float: The queue number.
+    """
+    now = time.time() if now is None else now
+    finish = get_finish(estimated_seconds, now, weight, flow_finish)
+    number = finish + min(SCHEDULER_SJF_WEIGHT * estimated_seconds / weight, SCHEDULER_MAX_AGING_SECONDS)
+    if deadline_seconds is not None:
+        number = max(finish, min(number, now + float(deadline_seconds) - estimated_seconds))
+    return number
+
+
+def get_queue_eta(queue, number, now=None):
+    """
+    Estimate the seconds until a prompt with the given queue number starts.
+
+    Uses the estimates stored in extra_data of the queued prompts by the inference server,
+    prompts queued by other clients are ignored.
+
+    Args:
+        queue (dict): The response of ComfyUI /queue.
+        number (float): The queue number of the prompt.
+        now (float, optional): The current time. Defaults to time.time().
+
+    Returns:
+        float: The expected seconds of waiting.
+    """
+    now = time.time() if now is None else now
+    eta = 0.0
+    for item in queue.get("queue_running", []):
+        extra_data = item[3] if len(item) > 3 else {}
+        started = extra_data.get("queued_at", now)
+        # the start time is unknown, assume it started when queued
+        eta += max(extra_data.get("estimated_seconds", 0.0) - (now - started), 0.0)
+    for item in queue.get("queue_pending", []):
+        extra_data = item[3] if len(item) > 3 else {}
+        if item[0] < number:
+            eta += extra_data.get("estimated_seconds", 0.0)
+    return eta
+
+
+def get_execution_timestamps(history):
+    """
+    Get the timestamps (in seconds) of the execution messages of a prompt from its ComfyUI history entry.
+
+    Returns:
+        dict: Message type (e.g. execution_start) to timestamp.
+    """
+    timestamps = {}
+    for message_type, data in history.get("status", {}).get("messages", []):
+        if isinstance(data, dict) and "timestamp" in data:
+            timestamps[message_type] = data["timestamp"] / 1000.0
+    return timestamps
+
+
+def get_execution_seconds(history):
+    """
+    Get the execution seconds of a prompt from its ComfyUI history entry.
+
+    Returns:
+        float: The seconds between execution start and end, or None if unknown.
+    """
+    timestamps = get_execution_timestamps(history)
+    start = timestamps.get("execution_start")
+    end = timestamps.get("execution_success")
+    if start is None or end is None:
+        return None
+    return end - start
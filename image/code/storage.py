@@ -0,0 +1,166 @@
+import logging
+import os
+import threading
+import time
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# environment variable to set the ComfyUI installation, its input/output/temp directories are managed
+COMFYUI_DIR = os.getenv("COMFYUI_DIR", "/opt/program/ComfyUI")
+
+# environment variables to set the limits enforced by the background sweeper on each directory
+STORAGE_TTL_SECONDS = int(os.getenv("STORAGE_TTL_SECONDS", 3600))
+STORAGE_MAX_BYTES = int(os.getenv("STORAGE_MAX_BYTES", 5 * 1024 ** 3))
+STORAGE_SWEEP_INTERVAL = int(os.getenv("STORAGE_SWEEP_INTERVAL", 60))
+
+# ComfyUI folder type -> directory
+DIRECTORIES = {
+    "input": os.path.join(COMFYUI_DIR, "input"),
+    "output": os.path.join(COMFYUI_DIR, "output"),
+    "temp": os.path.join(COMFYUI_DIR, "temp"),
+}
+
+
+def _remove(path):
+    # return the reclaimed bytes, 0 if the file is already gone
+    try:
+        size = os.path.getsize(path)
+        os.remove(path)
+        return size
+    except OSError:
+        return 0
+
+
+def get_file_path(filename, subfolder, folder_type):
+    """
+    Get the path of a file referenced by ComfyUI (as in /view), or None if it is outside of the managed directories.
+    """
+    directory = DIRECTORIES.get(folder_type)
+    if directory is None:
+        return None
+    path = os.path.abspath(os.path.join(directory, subfolder or "", filename))
+    if os.path.commonpath([path, os.path.abspath(directory)]) != os.path.abspath(directory):
+        return None
+    return path
+
+
+def remove_history_files(history):
+    """
+    Remove the files of all output nodes of a history entry.
+
+    Args:
+        history (dict): The ComfyUI history entry of a prompt.
+
+    Returns:
+        int: The reclaimed bytes.
+    """
+    reclaimed = 0
+    for node_output in history.get("outputs", {}).values():
+        for image in node_output.get("images", []):
+            path = get_file_path(image["filename"], image.get("subfolder"), image.get("type"))
+            if path is not None:
+                reclaimed += _remove(path)
+    metrics.incr("storage_reclaimed_bytes.request", reclaimed)
+    return reclaimed
+
+
+def remove_input_files(file_names):
+    """
+    Remove files uploaded to the ComfyUI input directory.
+
+    Args:
+        file_names (list): The file names of the uploaded images.
+
+    Returns:
+        int: The reclaimed bytes.
+    """
+    reclaimed = 0
+    for file_name in file_names:
+        path = get_file_path(file_name, "", "input")
+        if path is not None:
+            reclaimed += _remove(path)
+    metrics.incr("storage_reclaimed_bytes.request", reclaimed)
+    return reclaimed
+
+
+def sweep(directory, ttl_seconds=STORAGE_TTL_SECONDS, max_bytes=STORAGE_MAX_BYTES, now=None, since=None):
+    """
+    Remove files older than ttl_seconds, then the oldest files until the directory is below max_bytes.
+
+    Args:
+        directory (str): The directory to sweep, recursively.
+        ttl_seconds (int, optional): Maximum age of a file.
+        max_bytes (int, optional): Maximum total size of the swept files of the directory.
+        now (float, optional): The current time. Defaults to time.time().
+        since (float, optional): Only files modified since this time are swept, so that the files shipped
+            with ComfyUI (e.g. input/example.png) or staged before the server started are kept.
+
+    Returns:
+        tuple: The number of removed files and the reclaimed bytes.
+    """
+    now = time.time() if now is None else now
+    files = []
+    for root, _, names in os.walk(directory):
+        for name in names:
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if since is not None and stat.st_mtime < since:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+
+    files.sort()
+    total = sum(size for _, size, _ in files)
+    removed = 0
+    reclaimed = 0
+    for mtime, size, path in files:
+        if now - mtime <= ttl_seconds and total <= max_bytes:
+            break
+        freed = _remove(path)
+        total -= size
+        if freed:
+            removed += 1
+            reclaimed += freed
+    return removed, reclaimed
+
+
+def sweep_all(since=None):
+    """
+    Sweep all managed directories and record the reclaimed bytes in metrics.
+
+    Args:
+        since (float, optional): Only files modified since this time are swept.
+    """
+    for folder_type, directory in DIRECTORIES.items():
+        removed, reclaimed = sweep(directory, since=since)
+        if removed:
+            logger.info(f"Removed {removed} files ({reclaimed} bytes) from {directory}")
+            metrics.incr(f"storage_reclaimed_files.{folder_type}", removed)
+            metrics.incr(f"storage_reclaimed_bytes.{folder_type}", reclaimed)
+
+
+def start_sweeper(interval=STORAGE_SWEEP_INTERVAL):
+    """
+    Start a daemon thread sweeping all managed directories every interval seconds.
+    Only the files written since the sweeper started are swept.
+
+    Returns:
+        threading.Thread: The started thread.
+    """
+    started = time.time()
+
+    def run():
+        while True:
+            try:
+                sweep_all(started)
+            except Exception as e:
+                logger.error(f"Storage sweep failed: {e}")
+            time.sleep(interval)
+
+    thread = threading.Thread(target=run, name="storage-sweeper", daemon=True)
+    thread.start()
+    return thread
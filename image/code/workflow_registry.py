@@ -0,0 +1,289 @@
+import hashlib
+import json
+import logging
+import os
+import random
+import urllib.request
+
+logger = logging.getLogger(__name__)
+
+# placeholders used by workflow files for the prompt text (see DEVELOPMENT.md)
+POSITIVE_PROMPT_PLACEHOLDER = "POSITIVE_PROMT_PLACEHOLDER"
+NEGATIVE_PROMPT_PLACEHOLDER = "NEGATIVE_PROMPT_PLACEHOLDER"
+
+# name of the uploaded input image that LoadImage nodes are pointed to
+INPUT_IMAGE_NAME = "input1.png"
+
+# parameter name -> list of (class_type, input name) slots it is written to
+PARAMETER_SLOTS = {
+    "seed": [("KSampler", "seed")],
+    "steps": [("KSampler", "steps")],
+    "denoise": [("KSampler", "denoise")],
+    "cfg": [("KSampler", "cfg")],
+    "sampler_name": [("KSampler", "sampler_name")],
+    "width": [("EmptyLatentImage", "width"), ("EmptySD3LatentImage", "width"), ("ImageScale", "width")],
+    "height": [("EmptyLatentImage", "height"), ("EmptySD3LatentImage", "height"), ("ImageScale", "height")],
+    "tensors_file_name": [("CheckpointLoaderSimple", "ckpt_name")],
+    "n_samples": [("RepeatLatentBatch", "amount")],
+    "input_image_name": [("LoadImage", "image")],
+}
+
+# parameters converted to int before being written to the graph
+INT_PARAMETERS = ("seed", "steps", "width", "height", "n_samples")
+
+# choice inputs of uploaded files, not checked against /object_info as the files are uploaded per request
+UPLOADED_INPUTS = (("LoadImage", "image"),)
+
+
+class WorkflowError(Exception):
+    """Raised when a workflow cannot be resolved or parameterized."""
+
+
+def normalize_graph(graph):
+    """
+    Keep only the ComfyUI nodes of a workflow graph in API format.
+
+    Args:
+        graph (dict): The workflow graph as saved by ComfyUI (API format).
+
+    Returns:
+        dict: Node id to {"class_type", "inputs"} for every node of the graph.
+    """
+    return {
+        node_id: {"class_type": node["class_type"], "inputs": node["inputs"]}
+        for node_id, node in graph.items()
+        if isinstance(node, dict) and "class_type" in node
+    }
+
+
+class Workflow:
+    """
+    A named, versioned and pre-normalized workflow graph.
+
+    The node ids for every parameter slot and prompt placeholder are resolved once
+    when the workflow is loaded, so that a request only has to patch those inputs.
+    """
+
+    def __init__(self, name, graph, version):
+        self.name = name
+        self.version = version
+        self.graph = normalize_graph(graph)
+        self.valid = None
+        self.error = None
+        self.slots = {}
+        for parameter, targets in PARAMETER_SLOTS.items():
+            self.slots[parameter] = [
+                (node_id, input_name)
+                for node_id, node in self.graph.items()
+                for class_type, input_name in targets
+                if node["class_type"] == class_type and input_name in node["inputs"]
+            ]
+        # inputs that a request can override, their base value is only checked when it is used
+        self.slot_inputs = {slot for slots in self.slots.values() for slot in slots}
+        self.text_slots = {
+            "positive_prompt": self._find_text(POSITIVE_PROMPT_PLACEHOLDER),
+            "negative_prompt": self._find_text(NEGATIVE_PROMPT_PLACEHOLDER),
+        }
+        # named image inputs: LoadImage nodes by title and by node id
+        self.image_slots = {}
+        for node_id, node in self.graph.items():
+            if node["class_type"] == "LoadImage" and "image" in node["inputs"]:
+                title = graph[node_id].get("_meta", {}).get("title")
+                for name in {title, node_id} - {None}:
+                    self.image_slots.setdefault(name, []).append(node_id)
+
+    @property
+    def identity(self):
+        return f"{self.name}@{self.version}"
+
+    def _find_text(self, placeholder):
+        return [
+            node_id
+            for node_id, node in self.graph.items()
+            if node["class_type"] == "CLIPTextEncode" and node["inputs"].get("text") == placeholder
+        ]
+
+    def validate(self, object_info):
+        """
+        Validate the graph against ComfyUI /object_info.
+
+        Checks that every node class exists, every required input is set and every
+        constant value of a choice input is one of the allowed values. Inputs which are
+        parameter slots (e.g. ckpt_name) are checked by build instead, when they are not overridden.
+
+        Args:
+            object_info (dict): The response of ComfyUI /object_info.
+
+        Returns:
+            bool: True if the workflow is valid.
+        """
+        errors = []
+        for node_id, node in self.graph.items():
+            info = object_info.get(node["class_type"])
+            if info is None:
+                errors.append(f"node {node_id}: unknown class_type {node['class_type']}")
+                continue
+            required = info.get("input", {}).get("required", {})
+            for input_name, spec in required.items():
+                if input_name not in node["inputs"]:
+                    errors.append(f"node {node_id}: missing required input {input_name}")
+                    continue
+                value = node["inputs"][input_name]
+                if (node["class_type"], input_name) in UPLOADED_INPUTS or (node_id, input_name) in self.slot_inputs:
+                    continue
+                if isinstance(spec, list) and spec and isinstance(spec[0], list) and not isinstance(value, list):
+                    if value not in spec[0]:
+                        errors.append(f"node {node_id}: invalid value {value!r} for {input_name}")
+        self.valid = not errors
+        self.error = "; ".join(errors) if errors else None
+        return self.valid
+
+    def build(self, parameters, object_info=None):
+        """
+        Build a ComfyUI prompt from the cached graph and the request parameters.
+
+        Only the nodes referenced by a parameter are copied, the rest of the graph is
+        shared with the cached one and must not be modified.
+
+        Args:
+            parameters (dict): Parameter values, keys of PARAMETER_SLOTS plus positive_prompt and negative_prompt.
+                A random seed is used if seed is not given. input_images maps the name (title or node id)
+                of LoadImage nodes to the file name of their image.
+            object_info (dict, optional): ComfyUI /object_info used to check choice values of the parameters.
+
+        Returns:
+            dict: The prompt graph ready to be queued to ComfyUI.
+
+        Raises:
+            WorkflowError: If a parameter is unknown or has an invalid value.
+        """
+        unknown = set(parameters) - set(PARAMETER_SLOTS) - set(self.text_slots) - {"input_images"}
+        if unknown:
+            raise WorkflowError(f"unknown parameters: {', '.join(sorted(unknown))}")
+        input_images = parameters.get("input_images") or {}
+        unknown = set(input_images) - set(self.image_slots)
+        if unknown:
+            raise WorkflowError(f"no LoadImage node for image inputs: {', '.join(sorted(unknown))}")
+
+        values = {k: v for k, v in parameters.items() if v is not None and k != "input_images"}
+        if "seed" not in values:
+            values["seed"] = random.randint(0, int(1e10))
+
+        prompt = dict(self.graph)
+        overridden = set()
+
+        def set_input(node_id, input_name, value):
+            if prompt[node_id] is self.graph[node_id]:
+                node = self.graph[node_id]
+                prompt[node_id] = {"class_type": node["class_type"], "inputs": dict(node["inputs"])}
+            prompt[node_id]["inputs"][input_name] = value
+
+        for parameter, value in values.items():
+            if parameter in self.text_slots:
+                for node_id in self.text_slots[parameter]:
+                    set_input(node_id, "text", value)
+                continue
+            if parameter in INT_PARAMETERS:
+                try:
+                    value = int(value)
+                except (TypeError, ValueError):
+                    raise WorkflowError(f"parameter {parameter} must be an integer")
+            for node_id, input_name in self.slots[parameter]:
+                if object_info is not None:
+                    check_choice(object_info, self.graph[node_id]["class_type"], input_name, value)
+                set_input(node_id, input_name, value)
+                overridden.add((node_id, input_name))
+        if object_info is not None:
+            for node_id, input_name in self.slot_inputs - overridden:
+                node = self.graph[node_id]
+                check_choice(object_info, node["class_type"], input_name, node["inputs"][input_name])
+        for name, file_name in input_images.items():
+            for node_id in self.image_slots[name]:
+                set_input(node_id, "image", file_name)
+        return prompt
+
+
+def check_choice(object_info, class_type, input_name, value):
+    """
+    Raise WorkflowError if value is not an allowed choice of a node input.
+    Inputs which are not choice lists are not checked.
+    """
+    if (class_type, input_name) in UPLOADED_INPUTS:
+        return
+    spec = object_info.get(class_type, {}).get("input", {}).get("required", {}).get(input_name)
+    if isinstance(spec, list) and spec and isinstance(spec[0], list) and value not in spec[0]:
+        raise WorkflowError(f"invalid value {value!r} for {class_type}.{input_name}")
+
+
+class WorkflowRegistry:
+    """
+    Registry of the workflows loaded from a directory of ComfyUI API format json files.
+
+    The workflow name is the file name without extension, and its version is derived
+    from the file content, so a changed workflow gets a new identity.
+    """
+
+    def __init__(self, workflows=None):
+        self.workflows = workflows or {}
+        self.object_info = None
+
+    @classmethod
+    def load(cls, directory):
+        """
+        Load every *.json workflow of a directory.
+
+        Args:
+            directory (str): Path of the workflow directory. A missing directory results in an empty registry.
+
+        Returns:
+            WorkflowRegistry: The loaded registry.
+        """
+        workflows = {}
+        if not os.path.isdir(directory):
+            logger.info(f"Workflow directory {directory} not found, registry is empty")
+            return cls(workflows)
+        for file_name in sorted(os.listdir(directory)):
+            if not file_name.endswith(".json"):
+                continue
+            with open(os.path.join(directory, file_name), "rb") as f:
+                content = f.read()
+            name = file_name[: -len(".json")]
+            version = hashlib.sha256(content).hexdigest()[:12]
+            try:
+                workflows[name] = Workflow(name, json.loads(content), version)
+            except (ValueError, KeyError, TypeError) as e:
+                logger.error(f"Failed to load workflow {file_name}: {e}")
+        logger.info(f"Loaded {len(workflows)} workflows from {directory}")
+        return cls(workflows)
+
+    def validate(self, server_address):
+        """
+        Fetch /object_info from ComfyUI and validate all workflows against it.
+        It is done once, subsequent calls return immediately.
+
+        Args:
+            server_address (str): Address of the ComfyUI server.
+        """
+        if self.object_info is not None:
+            return
+        with urllib.request.urlopen("http://{}/object_info".format(server_address)) as response:
+            self.object_info = json.loads(response.read())
+        for workflow in self.workflows.values():
+            if not workflow.validate(self.object_info):
+                logger.error(f"Workflow {workflow.identity} is invalid: {workflow.error}")
+
+    def get(self, name, version=None):
+        """
+        Get a valid workflow by name, and optionally pin its version.
+
+        Raises:
+            WorkflowError: If the workflow does not exist, has another version or is invalid.
+        """
+        workflow = self.workflows.get(name)
+        if workflow is None:
+            raise WorkflowError(f"unknown workflow {name}")
+        if version is not None and version != workflow.version:
+            raise WorkflowError(f"workflow {name} has version {workflow.version}, requested {version}")
+        if workflow.valid is False:
+            raise WorkflowError(f"workflow {workflow.identity} is invalid: {workflow.error}")
+        return workflow
@@ -5,6 +5,10 @@ import random
 import base64
 import io
 import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
 
 # Define Logger
 logger = logging.getLogger()
@@ -12,6 +16,18 @@ logging.basicConfig()
 logger.setLevel(logging.INFO)
 
 sagemaker_client = boto3.client("sagemaker-runtime")
+s3_client = boto3.client("s3")
+
+# environment variable to set the size of the cache of input images kept in the warm container
+IMAGE_CACHE_MAX_BYTES = int(os.getenv("IMAGE_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+
+# (bucket, key) -> (etag, image bytes), least recently used first
+image_cache = OrderedDict()
+image_cache_lock = threading.Lock()
+
+# environment variable to send named workflow requests (workflow name plus parameters) instead of the full graph,
+# the workflows must be packed in the model artifact (see model/build.sh)
+USE_WORKFLOW_REGISTRY = os.getenv("USE_WORKFLOW_REGISTRY", "False").lower() in ("true", "1", "t")
 
 
 def update_seed(prompt_dict, seed=None):
@@ -186,32 +202,146 @@ def update_sample_size(prompt_dic, n_samples):
     return prompt_dic
 
 
+def update_scheduling_options(prompt_dict, lane=None, tenant=None, deadline_seconds=None, estimate_only=False):
+    """
+    Set the options used by the inference server to schedule the request.
+
+    Args:
+        prompt_dict (dict): The prompt dictionary.
+        lane (str, optional): The lane, e.g. interactive or bulk. Not set if None.
+        tenant (str, optional): The tenant. Not set if None.
+        deadline_seconds (float, optional): Seconds by which the request should be completed. Not set if None.
+        estimate_only (bool, optional): Only return the estimate and queue ETA, without executing the prompt.
+
+    Returns:
+        dict: The updated prompt dictionary.
+    """
+    if lane is not None:
+        prompt_dict["lane"] = lane
+    if tenant is not None:
+        prompt_dict["tenant"] = tenant
+    if deadline_seconds is not None:
+        prompt_dict["deadline_seconds"] = deadline_seconds
+    if estimate_only:
+        prompt_dict["estimate_only"] = True
+    return prompt_dict
+
+
+def update_input_images(prompt_dict, image_names):
+    """
+    Point each named LoadImage node to the file name of its image input.
+
+    A LoadImage node is named by its title (_meta.title) or its node id.
+
+    Args:
+        prompt_dict (dict): The prompt dictionary containing the node information.
+        image_names (list): The names of the image inputs, also used as their file names.
+
+    Returns:
+        dict: The updated prompt dictionary.
+
+    Raises:
+        KeyError: If an image input does not match any LoadImage node.
+    """
+    matched = set()
+    for i in prompt_dict:
+        if isinstance(prompt_dict[i], str):
+            continue
+        if prompt_dict[i].get("class_type") == "LoadImage" and "image" in prompt_dict[i].get("inputs", {}):
+            title = prompt_dict[i].get("_meta", {}).get("title")
+            name = title if title in image_names else i if i in image_names else None
+            if name is not None:
+                prompt_dict[i]["inputs"]["image"] = name
+                matched.add(name)
+    missing = set(image_names) - matched
+    if missing:
+        raise KeyError(f"no LoadImage node for image inputs {', '.join(sorted(missing))}")
+    return prompt_dict
+
+
 def get_image_from_url(url):
     """
     Get the image data from the provided URL.
 
+    The image is cached in the warm container by bucket, key and ETag, a cached image is
+    only downloaded again if the object has changed.
+
     Args:
         s3 url (str): The URL to fetch the image data from.
 
     Returns:
         bytes: The image data in bytes.
     """
-    # fetch image from boto client s3 url
-    boto3_client = boto3.client("s3")
     bucket_name = url.split("/")[2]
     key = "/".join(url.split("/")[3:])
-    response = boto3_client.get_object(Bucket=bucket_name, Key=key)
-    file_content = io.BytesIO(response["Body"].read())
     file_name = key.split("/")[-1]
-    return file_content, file_name
+
+    with image_cache_lock:
+        cached = image_cache.get((bucket_name, key))
+    try:
+        if cached is not None:
+            response = s3_client.get_object(Bucket=bucket_name, Key=key, IfNoneMatch=cached[0])
+        else:
+            response = s3_client.get_object(Bucket=bucket_name, Key=key)
+    except ClientError as e:
+        if cached is not None and e.response["ResponseMetadata"]["HTTPStatusCode"] == 304:
+            with image_cache_lock:
+                image_cache.move_to_end((bucket_name, key))
+            return io.BytesIO(cached[1]), file_name
+        raise
+
+    data = response["Body"].read()
+    with image_cache_lock:
+        image_cache[(bucket_name, key)] = (response["ETag"], data)
+        total = sum(len(v[1]) for v in image_cache.values())
+        while total > IMAGE_CACHE_MAX_BYTES and image_cache:
+            _, (_, evicted) = image_cache.popitem(last=False)
+            total -= len(evicted)
+    return io.BytesIO(data), file_name
+
+
+def get_image_urls(image_input, image_inputs):
+    """
+    Collect the S3 URLs of the single image input (as input1.png) and of the named image inputs.
+
+    Returns:
+        dict: Image input name to S3 URL.
+    """
+    urls = dict(image_inputs or {})
+    if image_input:
+        urls["input1.png"] = image_input
+    return urls
+
+
+def get_images_from_urls(urls):
+    """
+    Get the image data of several named S3 URLs concurrently.
+
+    Args:
+        urls (dict): Image input name to S3 URL.
+
+    Returns:
+        dict: Image input name to base64 encoded image data.
+    """
+    if not urls:
+        return {}
+    with ThreadPoolExecutor(max_workers=min(len(urls), 8)) as executor:
+        futures = {name: executor.submit(get_image_from_url, url) for name, url in urls.items()}
+    return {name: base64.b64encode(future.result()[0].getvalue()).decode("utf-8") for name, future in futures.items()}
 
 
 def invoke_from_prompt(prompt_file, positive_prompt, negative_prompt, seed=None, width=1024, height=1024,
-                       steps=20, denoise=1, cfg=8, sampler_name="euler", tensors_file_name=None, image_input=None, n_samples=None):
+                       steps=20, denoise=1, cfg=8, sampler_name="euler", tensors_file_name=None, image_input=None, n_samples=None,
+                       lane=None, tenant=None, image_inputs=None, deadline_seconds=None, estimate_only=False):
     """
     Invokes the SageMaker endpoint with the provided prompt data.
 
     Args:
+        estimate_only:  Only return the estimated execution seconds and queue ETA, without executing the prompt.
+        deadline_seconds:  Seconds by which the request should be completed.
+        lane:  The priority lane (e.g. interactive or bulk) of the request in the inference server.
+        tenant:  The tenant of the request, requests of a lane are queued fairly between tenants.
+        image_inputs:  Named image inputs (S3 URLs), each used by the LoadImage node with the same title or node id.
         image_input:  The image input to be used in the prompt data.
         tensors_file_name:  The tensors file name to be used in the prompt data.
         sampler_name:  The sampler name to be used in the prompt data.
@@ -233,6 +363,31 @@ def invoke_from_prompt(prompt_file, positive_prompt, negative_prompt, seed=None,
     """
     logger.info("prompt: %s", prompt_file)
 
+    if USE_WORKFLOW_REGISTRY:
+        prompt_dict = {
+            "workflow": os.path.splitext(prompt_file)[0],
+            "parameters": {
+                "positive_prompt": positive_prompt,
+                "negative_prompt": negative_prompt,
+                "seed": seed,
+                "width": width,
+                "height": height,
+                "steps": steps,
+                "denoise": denoise,
+                "cfg": cfg,
+                "sampler_name": sampler_name,
+                "tensors_file_name": tensors_file_name,
+                "n_samples": n_samples,
+            },
+        }
+        images = get_images_from_urls(get_image_urls(image_input, image_inputs))
+        if image_input:
+            prompt_dict["input_image"] = images.pop("input1.png")
+        if images:
+            prompt_dict["input_images"] = images
+        prompt_dict = update_scheduling_options(prompt_dict, lane, tenant, deadline_seconds, estimate_only)
+        return invoke_endpoint(json.dumps(prompt_dict))
+
     # read the prompt data from json file
     with open("./workflow/" + prompt_file) as prompt_file:
         prompt_text = prompt_file.read()
@@ -244,15 +399,31 @@ def invoke_from_prompt(prompt_file, positive_prompt, negative_prompt, seed=None,
     prompt_dict = update_Sampler_details(prompt_dict, steps, denoise, cfg, sampler_name)
     prompt_dict = update_tensors_file_name(prompt_dict, tensors_file_name)
     prompt_dict = update_sample_size(prompt_dict, n_samples)
+    # fetch all images concurrently
+    images = get_images_from_urls(get_image_urls(image_input, image_inputs))
     if image_input:
-        url = image_input
-        image_data, file_name = get_image_from_url(url)
         # add a new field to the prompt_dict
-        prompt_dict["input_image"] = base64.b64encode(image_data.getvalue()).decode("utf-8")
+        prompt_dict["input_image"] = images.pop("input1.png")
         prompt_dict = update_input_image_name(prompt_dict, "input1.png")
+    if images:
+        prompt_dict = update_input_images(prompt_dict, list(images))
+        prompt_dict["input_images"] = images
+    prompt_dict = update_scheduling_options(prompt_dict, lane, tenant, deadline_seconds, estimate_only)
 
     prompt_text = json.dumps(prompt_dict)
+    return invoke_endpoint(prompt_text)
+
+
+def invoke_endpoint(prompt_text):
+    """
+    Invoke the SageMaker endpoint with the prompt payload.
 
+    Args:
+        prompt_text (str): The JSON payload to send.
+
+    Returns:
+        dict: The response from the SageMaker endpoint.
+    """
     endpoint_name = os.environ["ENDPOINT_NAME"]
     content_type = "application/json"
     accept = "*/*"
@@ -277,12 +448,22 @@ def lambda_handler(event: dict, context: dict):
     logger.info(json.dumps(event, indent=2))
     request = json.loads(event["body"])
 
+    if request.get("status") is True:
+        # health state and metrics of the endpoint instance that serves the request
+        response = invoke_endpoint(json.dumps({"status": True}))
+        return {
+            "statusCode": response["ResponseMetadata"]["HTTPStatusCode"],
+            "body": response["Body"].read().decode("utf-8"),
+            "headers": {"Content-Type": "application/json"}
+        }
+
     try:
         # Extract request parameters
         prompt_file = request.get("prompt_file", "SDXL.json")
         positive_prompt = request["positive_prompt"]
         negative_prompt = request.get("negative_prompt", "")
         image_input = request.get("image_input", None)
+        image_inputs = request.get("image_inputs", None)
         width = request.get("width", 1024)
         height = request.get("height", 1024)
         seed = request.get("seed")
@@ -292,6 +473,10 @@ def lambda_handler(event: dict, context: dict):
         sampler_name = request.get("sampler_name", "euler")
         tensors_file_name = request.get("tensors_file_name", None)
         n_samples = request.get("n_samples", None)
+        lane = request.get("lane", None)
+        tenant = request.get("tenant", None)
+        deadline_seconds = request.get("deadline_seconds", None)
+        estimate_only = request.get("estimate_only", False)
 
         payload_to_send = {
             "prompt_file": prompt_file,
@@ -306,7 +491,12 @@ def lambda_handler(event: dict, context: dict):
             "sampler_name": sampler_name,
             "tensors_file_name": tensors_file_name,
             "image_input": image_input,
-            "n_samples": n_samples
+            "image_inputs": image_inputs,
+            "n_samples": n_samples,
+            "lane": lane,
+            "tenant": tenant,
+            "deadline_seconds": deadline_seconds,
+            "estimate_only": estimate_only
         }
         logger.info("Payload to send: %s", payload_to_send)
 
@@ -323,7 +513,12 @@ def lambda_handler(event: dict, context: dict):
             sampler_name=sampler_name,
             tensors_file_name=tensors_file_name,
             image_input=image_input,
-            n_samples=n_samples
+            n_samples=n_samples,
+            lane=lane,
+            tenant=tenant,
+            image_inputs=image_inputs,
+            deadline_seconds=deadline_seconds,
+            estimate_only=estimate_only
         )
     except KeyError as e:
         logger.error(f"Error: {e}")
@@ -336,6 +531,16 @@ def lambda_handler(event: dict, context: dict):
                 }
             ),
         }
+    except ClientError as e:
+        # the endpoint returned an error, e.g. 429 when the lane of the request is full
+        if e.response.get("Error", {}).get("Code") != "ModelError":
+            raise
+        logger.error(f"Error: {e}")
+        return {
+            "statusCode": e.response.get("OriginalStatusCode", 502),
+            "body": e.response.get("OriginalMessage", json.dumps({"error": str(e)})),
+            "headers": {"Content-Type": "application/json"}
+        }
 
     # Read response body
     response_body = response["Body"].read()
@@ -344,12 +549,30 @@ def lambda_handler(event: dict, context: dict):
         # Try to parse as JSON (new format with multiple images)
         response_data = json.loads(response_body)
 
+        if "error" in response_data:
+            # the inference server failed to build the response
+            logger.error(f"Error: {response_data}")
+            return {
+                "statusCode": 502,
+                "body": json.dumps(response_data),
+                "headers": {"Content-Type": "application/json"}
+            }
+
+        if "images" not in response_data:
+            # estimate only request
+            return {
+                "statusCode": response["ResponseMetadata"]["HTTPStatusCode"],
+                "body": json.dumps({"estimate": response_data.get("estimate")}),
+                "headers": {"Content-Type": "application/json"}
+            }
+
         # Return all images with their metadata
         result = {
             "statusCode": response["ResponseMetadata"]["HTTPStatusCode"],
             "body": json.dumps({
                 "images": response_data["images"],
                 "total_images": response_data["total_images"],
+                "estimate": response_data.get("estimate"),
                 "metadata": {
                     "content_type": response["ContentType"],
                     "request_id": response["ResponseMetadata"]["RequestId"]
@@ -360,7 +583,15 @@ def lambda_handler(event: dict, context: dict):
                 "X-Total-Images": str(response_data["total_images"])
             }
         }
-    except json.JSONDecodeError:
+    except json.JSONDecodeError as e:
+        if response["ContentType"] == "application/json":
+            # a truncated or invalid JSON response is not an image
+            logger.error(f"Error: {e}")
+            return {
+                "statusCode": 502,
+                "body": json.dumps({"error": "Invalid response from the endpoint", "details": str(e)}),
+                "headers": {"Content-Type": "application/json"}
+            }
         # Fall back to old format (single binary image)
         logger.info("Falling back to single image format")
         result = {
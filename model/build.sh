@@ -47,6 +47,10 @@ do
     mkdir -p "${TARGET_DIR}/${dir}"
 done
 
+# named workflows loaded by the inference server at startup (see WORKFLOW_DIR)
+mkdir -p "${TARGET_DIR}/workflows"
+cp ../lambda/workflow/*.json "${TARGET_DIR}/workflows/"
+
 # download models that you want to include
 #
 download_huggingface 'https://civitai.com/api/download/models/1408658?type=Model&format=SafeTensor&size=full&fp=fp16' "${TARGET_DIR}/checkpoints" "AnImageinXL40.safetensors"